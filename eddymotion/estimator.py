@@ -7,7 +7,7 @@ import numpy as np
 import nibabel as nb
 import nitransforms as nt
 from nipype.interfaces.ants.registration import Registration
-from eddymotion.model import ModelFactory
+from eddymotion.model import ModelFactory, WorkerPool
 
 
 class EddyMotionEstimator:
@@ -72,63 +72,67 @@ class EddyMotionEstimator:
         if "n_threads" in kwargs:
             align_kwargs["num_threads"] = kwargs["n_threads"]
 
-        for i_iter in range(1, n_iter + 1):
-            index_order = np.arange(len(dwdata))
-            np.random.shuffle(index_order)
-            with tqdm(total=len(index_order), unit="dwi") as pbar:
-                for i in index_order:
-                    # run a original-to-synthetic affine registration
-                    with TemporaryDirectory() as tmpdir:
-                        pbar.write(
-                            f"Pass {i_iter}/{n_iter} | Processing b-index <{i}> in <{tmpdir}>"
-                        )
-                        data_train, data_test = dwdata.logo_split(i, with_b0=True)
-
-                        # Factory creates the appropriate model and pipes arguments
-                        dwmodel = ModelFactory.init(
-                            gtab=data_train[1], model=model, **kwargs
-                        )
-
-                        # fit the model
-                        dwmodel.fit(data_train[0])
-
-                        # generate a synthetic dw volume for the test gradient
-                        predicted = dwmodel.predict(data_test[1])
-
-                        tmpdir = Path(tmpdir)
-                        moving = tmpdir / "moving.nii.gz"
-                        fixed = tmpdir / "fixed.nii.gz"
-                        _to_nifti(data_test[0], dwdata.affine, moving)
-                        _to_nifti(predicted, dwdata.affine, fixed, clip=reg_target_type == "dwi")
-                        registration = Registration(
-                            terminal_output="file",
-                            from_file=pkg_fn(
-                                "eddymotion",
-                                f"config/dwi-to-{reg_target_type}_level{i_iter}.json",
-                            ),
-                            fixed_image=str(fixed.absolute()),
-                            moving_image=str(moving.absolute()),
-                            **align_kwargs,
-                        )
-                        if bmask_img:
-                            registration.inputs.fixed_image_masks = ["NULL", bmask_img]
-
-                        if dwdata.em_affines and dwdata.em_affines[i] is not None:
-                            mat_file = tmpdir / f"init{i_iter}.mat"
-                            dwdata.em_affines[i].to_filename(mat_file, fmt="itk")
-                            registration.inputs.initial_moving_transform = str(mat_file)
-
-                        # execute ants command line
-                        result = registration.run(cwd=str(tmpdir)).outputs
-
-                        # read output transform
-                        xform = nt.io.itk.ITKLinearTransform.from_filename(
-                            result.forward_transforms[0]
-                        ).to_ras(reference=fixed, moving=moving)
-
-                    # update
-                    dwdata.set_transform(i, xform)
-                    pbar.update()
+        # Models share a single pool of worker processes across all iterations
+        with WorkerPool(kwargs.get("n_threads")) as pool:
+            for i_iter in range(1, n_iter + 1):
+                index_order = np.arange(len(dwdata))
+                np.random.shuffle(index_order)
+                with tqdm(total=len(index_order), unit="dwi") as pbar:
+                    for i in index_order:
+                        # run a original-to-synthetic affine registration
+                        with TemporaryDirectory() as tmpdir:
+                            pbar.write(
+                                f"Pass {i_iter}/{n_iter} | Processing b-index <{i}> in <{tmpdir}>"
+                            )
+                            data_train, data_test = dwdata.logo_split(i, with_b0=True)
+
+                            # Factory creates the appropriate model and pipes arguments
+                            dwmodel = ModelFactory.init(
+                                gtab=data_train[1], model=model, pool=pool, **kwargs
+                            )
+
+                            # fit the model
+                            dwmodel.fit(data_train[0])
+
+                            # generate a synthetic dw volume for the test gradient
+                            predicted = dwmodel.predict(data_test[1])
+
+                            tmpdir = Path(tmpdir)
+                            moving = tmpdir / "moving.nii.gz"
+                            fixed = tmpdir / "fixed.nii.gz"
+                            _to_nifti(data_test[0], dwdata.affine, moving)
+                            _to_nifti(
+                                predicted, dwdata.affine, fixed, clip=reg_target_type == "dwi"
+                            )
+                            registration = Registration(
+                                terminal_output="file",
+                                from_file=pkg_fn(
+                                    "eddymotion",
+                                    f"config/dwi-to-{reg_target_type}_level{i_iter}.json",
+                                ),
+                                fixed_image=str(fixed.absolute()),
+                                moving_image=str(moving.absolute()),
+                                **align_kwargs,
+                            )
+                            if bmask_img:
+                                registration.inputs.fixed_image_masks = ["NULL", bmask_img]
+
+                            if dwdata.em_affines and dwdata.em_affines[i] is not None:
+                                mat_file = tmpdir / f"init{i_iter}.mat"
+                                dwdata.em_affines[i].to_filename(mat_file, fmt="itk")
+                                registration.inputs.initial_moving_transform = str(mat_file)
+
+                            # execute ants command line
+                            result = registration.run(cwd=str(tmpdir)).outputs
+
+                            # read output transform
+                            xform = nt.io.itk.ITKLinearTransform.from_filename(
+                                result.forward_transforms[0]
+                            ).to_ras(reference=fixed, moving=moving)
+
+                        # update
+                        dwdata.set_transform(i, xform)
+                        pbar.update()
 
         return dwdata.em_affines
 
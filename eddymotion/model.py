@@ -1,21 +1,59 @@
 """A factory class that adapts DIPY's dMRI models."""
 from os import cpu_count
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import repeat
 import warnings
-from concurrent.futures import ThreadPoolExecutor
-import asyncio
-import nest_asyncio
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_all_start_methods, get_context
+from multiprocessing.shared_memory import SharedMemory
 
 import numpy as np
+from threadpoolctl import threadpool_limits
 from dipy.core.gradients import gradient_table
-
-nest_asyncio.apply()
+from dipy.reconst.dki import DiffusionKurtosisModel
+from dipy.reconst.dti import (
+    MIN_POSITIVE_SIGNAL,
+    TensorFit,
+    TensorModel as DipyTensorModel,
+    eig_from_lo_tri,
+    ols_fit_tensor,
+    wls_fit_tensor,
+)
+
+try:
+    from numba import (
+        config as numba_config,
+        get_num_threads,
+        njit,
+        prange,
+        set_num_threads,
+        threading_layer,
+    )
+except ImportError:  # numba is an optional dependency
+    njit = None
+    prange = range
+
+
+def _l2_cache_size(default=256 * 1024):
+    """Return the size (in bytes) of the L2 cache, or ``default`` if unknown."""
+    try:
+        from os import sysconf
+
+        size = sysconf("SC_LEVEL2_CACHE_SIZE")
+    except (ImportError, ValueError, OSError):
+        size = 0
+    return size if size > 0 else default
+
+
+_L2_CACHE_SIZE = _l2_cache_size()
 
 
 class ModelFactory:
     """A factory for instantiating diffusion models."""
 
     @staticmethod
-    def init(gtab, model="DTI", **kwargs):
+    def init(gtab, model="DTI", mask=None, pool=None, **kwargs):
         """
         Instatiate a diffusion model.
 
@@ -26,6 +64,15 @@ class ModelFactory:
         model : :obj:`str`
             Diffusion model.
             Options: ``"3DShore"``, ``"SFM"``, ``"DTI"``, ``"DKI"``, ``"S0"``
+        mask : :obj:`numpy.ndarray`
+            A precomputed brain mask for the ``"DTI"`` and ``"DKI"`` models.
+            When the same mask is passed at every call (e.g., across the
+            iterations of the registration loop), the models do not need to
+            estimate it again from *S0*.
+        pool : :obj:`WorkerPool`
+            A pool of worker processes for the ``"DTI"`` model to share with other
+            models (e.g., across the iterations of the registration loop), rather
+            than starting its own.
 
         Return
         ------
@@ -62,6 +109,7 @@ class ModelFactory:
 
         elif model.lower() in ("dti", "dki"):
             Model = DTIModel if model.lower() == "dti" else DKIModel
+            param = {"mask": mask, "pool": pool}
 
         else:
             raise NotImplementedError(f"Unsupported model <{model}>.")
@@ -99,31 +147,42 @@ class TrivialB0Model:
 
 
 class DTIModel:
-    """A wrapper of :obj:`dipy.reconst.dti.TensorModel."""
+    """
+    A wrapper of :obj:`dipy.reconst.dti.TensorModel.
 
-    __slots__ = ("_model", "_S0", "_mask")
+    Fits and predictions that are not handled by the compiled kernels run in a
+    pool of worker processes. If numba's parallel kernels have already run in
+    the calling process (e.g., to normalize *S0*), these workers are not forked
+    from it but started fresh (``forkserver`` or ``spawn``), so scripts using
+    this model must then guard their entry point with ``if __name__ == "__main__":``.
 
-    def __init__(self, gtab, S0=None, mask=None, **kwargs):
-        """Instantiate the wrapped tensor model."""
-        from dipy.reconst.dti import TensorModel as DipyTensorModel
+    """
 
+    __slots__ = (
+        "_model",
+        "_model_kwargs",
+        "_params",
+        "_model_S0",
+        "_chunks",
+        "_n_threads",
+        "_gradient",
+        "_pool",
+        "_owns_pool",
+        "_S0",
+        "_mask",
+    )
+
+    def __init__(self, gtab, S0=None, mask=None, pool=None, **kwargs):
+        """Instantiate the wrapped tensor model."""
         n_threads = kwargs.pop("n_threads", 0) or 0
         n_threads = n_threads if n_threads > 0 else cpu_count()
 
-        self._S0 = None
-        if S0 is not None:
-            self._S0 = np.clip(
-                S0.astype("float32") / S0.max(),
-                a_min=1e-5,
-                a_max=1.0,
-            )
-
         self._mask = mask > 0 if mask is not None else None
-        if self._mask is None and self._S0 is not None:
-            self._mask = self._S0 > np.percentile(self._S0, 35)
 
-        if self._S0 is not None:
-            self._S0 = self._S0[self._mask]
+        self._S0 = None
+        if S0 is not None:
+            with _numba_threads(n_threads):
+                self._S0, self._mask = _masked_S0(S0, self._mask)
 
         kwargs = {
             k: v
@@ -138,102 +197,209 @@ class DTIModel:
                 "jac",
             )
         }
-        self._model = [DipyTensorModel(gtab, **kwargs)] * n_threads
+        self._model = DipyTensorModel(gtab, **kwargs)
+        self._model_kwargs = kwargs
+        self._n_threads = n_threads
+        # Workers rebuild the tensor model from the RAS+B gradients and arguments
+        self._gradient = np.vstack((gtab.bvecs.T, gtab.bvals))
+        self._owns_pool = pool is None
+        self._pool = WorkerPool(n_threads) if pool is None else pool
+        self._params = None
+        self._model_S0 = None
+        self._chunks = None
 
     def fit(self, data, **kwargs):
-        """Fit the model chunk-by-chunk asynchronously."""
-        _nthreads = len(self._model)
-
+        """Fit the model chunk-by-chunk in parallel worker processes."""
         # All-true mask if not available
         if self._mask is None:
             self._mask = np.ones(data.shape[:3], dtype=bool)
 
-        # Apply mask (ensures data is now 2D)
+        # Apply mask (ensures data is now 2D) into a single contiguous buffer
         data = data[self._mask, ...]
 
-        # Split data into chunks of group of slices
-        data_chunks = np.array_split(data, _nthreads)
-
-        # Run asyncio tasks in a limited thread pool.
-        with ThreadPoolExecutor(max_workers=_nthreads) as executor:
-            loop = asyncio.new_event_loop()
-
-            fit_tasks = [
-                loop.run_in_executor(
-                    executor,
+        # Split data into zero-copy views of contiguous voxel ranges,
+        # sized so that each chunk's signal fits in the L2 cache
+        n_vox = data.shape[0]
+        chunk_vox = max(1024, _L2_CACHE_SIZE // (data.shape[1] * data.itemsize))
+        self._chunks = _chunk_slices(n_vox, -(-n_vox // chunk_vox))
+
+        if _jit_fittable(self._model):
+            # Linear (OLS/WLS) fits are solved voxelwise by a compiled kernel
+            with _numba_threads(self._n_threads):
+                self._params, self._model_S0 = _jit_fit(self._model, data)
+            return
+
+        data_chunks = [data[chunk] for chunk in self._chunks]
+
+        # Workers write the fitted parameters (and S0 if estimated) in place
+        # into a shared buffer, rather than pickling TensorFit objects back.
+        shape = (n_vox, 12 + bool(self._model.return_S0_hat))
+        shm = SharedMemory(create=True, size=max(int(np.prod(shape)) * 8, 1))
+        try:
+            # Fitting is CPU-bound and holds the GIL: run each chunk in its own process.
+            # Consume the iterator so that worker exceptions are raised here.
+            list(
+                self._pool.map(
                     _model_fit,
-                    model,
-                    data,
+                    data_chunks,
+                    repeat(self._gradient),
+                    repeat(self._model_kwargs),
+                    repeat(shm.name),
+                    self._chunks,
+                    repeat(shape),
                 )
-                for model, data in zip(self._model, data_chunks)
-            ]
+            )
 
+            # Copy out, and release the view before closing the block even on errors
+            shared = np.ndarray(shape, dtype="float64", buffer=shm.buf)
             try:
-                self._model = loop.run_until_complete(asyncio.gather(*fit_tasks))
+                params = shared.copy()
             finally:
-                loop.close()
+                del shared
+        finally:
+            shm.close()
+            shm.unlink()
 
-    @staticmethod
-    def _predict_sub(submodel, gradient, S0_chunk, step):
-        """Call predict for chunk and return the predicted diffusion signal."""
-        return submodel.predict(gradient, S0=S0_chunk, step=step)
+        self._params = params[:, :12]
+        self._model_S0 = params[:, 12] if shape[1] > 12 else None
 
     def predict(self, gradient, step=None, **kwargs):
-        """Predict asynchronously chunk-by-chunk the diffusion signal."""
-        _nthreads = len(self._model)
-        S0 = [None] * _nthreads
+        """Predict chunk-by-chunk the diffusion signal in parallel worker processes."""
+        # Build the GradientTable once (memoized) for the parent process
+        gtab = _rasb2dipy(gradient)
+
+        if njit is not None:
+            # Evaluate the fitted tensors with a compiled kernel, bypassing DIPY.
+            # As TensorFit.predict, fall back on the estimated S0, then on ones.
+            n_vox = self._params.shape[0]
+            S0 = self._S0
+            if S0 is None:
+                S0 = self._model_S0 if self._model_S0 is not None else np.ones(n_vox)
+
+            predicted = np.empty((n_vox, len(gtab.bvals)), dtype="float32")
+            with _numba_threads(self._n_threads):
+                _predict_tensor(
+                    self._params,
+                    np.asarray(S0, dtype="float32"),
+                    np.ascontiguousarray(gtab.bvals, dtype=np.float64),
+                    np.ascontiguousarray(gtab.bvecs, dtype=np.float64),
+                    predicted,
+                )
+            return self._to_volume(predicted)
+
+        S0 = repeat(None)
         if self._S0 is not None:
-            S0 = np.array_split(self._S0, _nthreads)
-
-        # Run asyncio tasks in a limited thread pool.
-        with ThreadPoolExecutor(max_workers=_nthreads) as executor:
-            loop = asyncio.new_event_loop()
-
-            predict_tasks = [
-                loop.run_in_executor(
-                    executor,
-                    self._predict_sub,
-                    model,
-                    _rasb2dipy(gradient),
-                    S0_chunk,
-                    step,
+            S0 = [self._S0[chunk] for chunk in self._chunks]
+
+        model_S0 = repeat(None)
+        if self._model_S0 is not None:
+            model_S0 = [self._model_S0[chunk] for chunk in self._chunks]
+
+        # Workers receive the raw parameters and RAS+B array, much lighter to pickle
+        # with every task than TensorFit and GradientTable objects, and wrap them
+        # with their own tensor model and a (memoized) GradientTable, respectively.
+        # They write their chunk in place into a shared buffer, in half precision
+        # if the predictions are bounded by a normalized (or unit) S0.
+        dtype = np.dtype(
+            "float16" if self._S0 is not None or self._model_S0 is None else "float32"
+        )
+        shape = (self._chunks[-1].stop, len(gtab.bvals))
+        shm = SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+        try:
+            # Consume the iterator so that worker exceptions are raised here
+            list(
+                self._pool.map(
+                    _predict_sub,
+                    repeat(self._gradient),
+                    repeat(self._model_kwargs),
+                    [self._params[chunk] for chunk in self._chunks],
+                    model_S0,
+                    repeat(np.asanyarray(gradient)),
+                    S0,
+                    repeat(step),
+                    repeat(shm.name),
+                    self._chunks,
+                    repeat(shape),
+                    repeat(dtype.str),
                 )
-                for model, S0_chunk in zip(self._model, S0)
-            ]
+            )
 
+            # Upcast to single precision only at the final scatter
+            # Release the view before closing the block, even on errors
+            predicted = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
             try:
-                predicted = loop.run_until_complete(asyncio.gather(*predict_tasks))
+                retval = self._to_volume(predicted)
             finally:
-                loop.close()
+                del predicted
+        finally:
+            shm.close()
+            shm.unlink()
 
-        predicted = np.squeeze(np.concatenate(predicted, axis=0))
-        retval = np.zeros_like(self._mask, dtype="float32")
-        retval[self._mask] = predicted
+        return retval
+
+    def __enter__(self):
+        """Use the model as a context manager that shuts its workers down on exit."""
+        return self
+
+    def __exit__(self, *args):
+        """Shut down the worker processes."""
+        self.close()
+
+    def close(self, wait=True):
+        """Shut down the worker processes, unless the pool is shared with other models."""
+        if getattr(self, "_owns_pool", False):
+            self._pool.close(wait=wait)
+
+    def _to_volume(self, predicted):
+        """Scatter the masked predictions into a single-precision volume."""
+        retval = np.zeros(self._mask.shape, dtype="float32")
+        retval[self._mask] = np.squeeze(predicted)
         return retval
 
 
 class DKIModel:
-    """A wrapper of :obj:`dipy.reconst.dki.DiffusionKurtosisModel."""
+    """
+    A wrapper of :obj:`dipy.reconst.dki.DiffusionKurtosisModel.
+
+    Masks of any integer type are accepted, and *S0* is optional:
+
+    >>> rng = np.random.default_rng(1234)
+    >>> bvecs = rng.normal(size=(30, 3))
+    >>> bvecs /= np.linalg.norm(bvecs, axis=1)[:, np.newaxis]
+    >>> rasb = np.hstack((bvecs, [[1000]] * 15 + [[2000]] * 15))
+    >>> rasb = np.vstack(([[0, 0, 0, 0]] * 2, rasb)).T
+    >>> mask = np.zeros((2, 2, 2), dtype="uint8")
+    >>> mask[0] = 1
+    >>> model = ModelFactory.init(gtab=rasb, model="DKI", mask=mask)
+    >>> model.fit(rng.uniform(200, 1000, size=(2, 2, 2, 32)))
+    >>> predicted = model.predict([1, 0, 0, 1000])
+    >>> predicted.shape, predicted.dtype, bool(np.all(predicted[1] == 0))
+    ((2, 2, 2), dtype('float32'), True)
 
-    __slots__ = ("_model", "_S0", "_mask")
+    """
+
+    __slots__ = ("_model", "_S0", "_mask", "_flat_idx")
 
     def __init__(self, gtab, S0=None, mask=None, **kwargs):
         """Instantiate the wrapped tensor model."""
-        from dipy.reconst.dki import DiffusionKurtosisModel
+        n_threads = kwargs.pop("n_threads", 0) or 0
+        n_threads = n_threads if n_threads > 0 else cpu_count()
 
-        self._S0 = None
-        if S0 is not None:
-            self._S0 = np.clip(
-                S0.astype("float32") / S0.max(),
-                a_min=1e-5,
-                a_max=1.0,
-            )
-        self._mask = mask
-        if mask is None and S0 is not None:
-            self._mask = self._S0 > np.percentile(self._S0, 35)
+        self._mask = mask > 0 if mask is not None else None
 
+        # Flat indices of the mask, used for all masked reads and writes
+        self._flat_idx = None
         if self._mask is not None:
-            self._S0 = self._S0[self._mask.astype(bool)]
+            self._flat_idx = np.flatnonzero(self._mask)
+
+        self._S0 = None
+        if S0 is not None:
+            with _numba_threads(n_threads):
+                if self._flat_idx is None:
+                    self._S0, self._mask = _masked_S0(S0)
+                    self._flat_idx = np.flatnonzero(self._mask)
+                else:
+                    self._S0 = np.take(_normalize_S0(S0), self._flat_idx)
 
         kwargs = {
             k: v
@@ -252,24 +418,78 @@ class DKIModel:
 
     def fit(self, data, **kwargs):
         """Clean-up permitted args and kwargs, and call model's fit."""
-        self._model = self._model.fit(data[self._mask, ...])
+        # All-true mask if not available
+        if self._mask is None:
+            self._mask = np.ones(data.shape[:3], dtype=bool)
+            self._flat_idx = np.flatnonzero(self._mask)
+
+        data = np.take(data.reshape(-1, data.shape[-1]), self._flat_idx, axis=0)
+        self._model = self._model.fit(data)
 
     def predict(self, gradient, **kwargs):
         """Propagate model parameters and call predict."""
         predicted = np.squeeze(
             self._model.predict(
                 _rasb2dipy(gradient),
-                S0=self._S0,
+                S0=self._S0 if self._S0 is not None else 1.0,
             )
         )
         if predicted.ndim == 3:
             return predicted
 
-        retval = np.zeros_like(self._mask, dtype="float32")
-        retval[self._mask, ...] = predicted
+        retval = np.zeros(self._mask.shape, dtype="float32")
+        retval.ravel()[self._flat_idx] = predicted
         return retval
 
 
+class WorkerPool:
+    """
+    A pool of worker processes, which several models may share.
+
+    The processes are started on first use, and then kept until the pool is
+    closed. Passing the same pool to all the models built along the registration
+    loop (see :obj:`ModelFactory.init`) thus starts the workers only once.
+
+    """
+
+    __slots__ = ("_n_threads", "_executor")
+
+    def __init__(self, n_threads=None):
+        """Set up the pool, without starting any process yet."""
+        self._n_threads = n_threads if n_threads and n_threads > 0 else cpu_count()
+        self._executor = None
+
+    def map(self, fn, *iterables):
+        """Map ``fn`` over ``iterables`` in the worker processes, starting them if needed."""
+        if self._executor is None:
+            # The start method depends on the state of the calling process at this point
+            self._executor = ProcessPoolExecutor(
+                max_workers=self._n_threads,
+                mp_context=_mp_context(),
+                initializer=_worker_init,
+            )
+        return self._executor.map(fn, *iterables)
+
+    def __enter__(self):
+        """Use the pool as a context manager that shuts its workers down on exit."""
+        return self
+
+    def __exit__(self, *args):
+        """Shut down the worker processes."""
+        self.close()
+
+    def __del__(self):
+        """Shut down the worker processes."""
+        self.close(wait=False)
+
+    def close(self, wait=True):
+        """Shut down the worker processes, if they were started."""
+        executor = getattr(self, "_executor", None)
+        if executor is not None:
+            self._executor = None
+            executor.shutdown(wait=wait)
+
+
 def _rasb2dipy(gradient):
     gradient = np.asanyarray(gradient)
     if gradient.ndim == 1:
@@ -282,11 +502,384 @@ def _rasb2dipy(gradient):
     elif gradient.shape == (4, 4):
         print("Warning: make sure gradient information is not transposed!")
 
+    return _gradient_table(gradient.tobytes(), gradient.shape, gradient.dtype.str)
+
+
+@lru_cache(maxsize=8)
+def _gradient_table(buffer, shape, dtype):
+    """Build (and memoize) a DIPY GradientTable from a serialized RAS+B array."""
+    gradient = np.frombuffer(buffer, dtype=dtype).reshape(shape)
     with warnings.catch_warnings():
         warnings.filterwarnings("ignore", category=UserWarning)
         retval = gradient_table(gradient[3, :], gradient[:3, :].T)
     return retval
 
 
-def _model_fit(model, data):
-    return model.fit(data)
+def _normalize_S0(S0):
+    """
+    Scale *S0* by its maximum and clip it into [1e-5, 1] as single precision.
+
+    >>> S0 = _normalize_S0(np.array([0, 50, 100], dtype="int16"))
+    >>> S0.dtype, np.allclose(S0, [1e-5, 0.5, 1.0])
+    (dtype('float32'), True)
+
+    """
+    S0 = np.asanyarray(S0)
+    retval = np.empty(S0.shape, dtype="float32")
+    if njit is None:
+        np.divide(S0, S0.max(), out=retval, casting="unsafe")
+        np.clip(retval, 1e-5, 1.0, out=retval)
+    else:
+        _normalize_clip(retval.ravel(), S0.ravel(), float(S0.max()))
+    return retval
+
+
+def _threshold_mask(data, q):
+    """
+    Select the values above the ``q``-th percentile of ``data``.
+
+    The percentile is found with :obj:`numpy.partition` (linear time) rather than
+    by sorting as :obj:`numpy.percentile` does, taking the nearest rank below.
+
+    >>> _threshold_mask(np.arange(10.0), 35)
+    array([False, False, False, False,  True,  True,  True,  True,  True,  True])
+
+    """
+    return data > _percentile(data, q)
+
+
+def _percentile(data, q):
+    """Find the ``q``-th percentile (nearest rank below) in linear time."""
+    k = int(q / 100 * (data.size - 1))
+    return np.partition(data, k, axis=None)[k]
+
+
+def _masked_S0(S0, mask=None, q=35):
+    """
+    Normalize *S0* and extract the voxels within the mask.
+
+    If no ``mask`` is given, it is derived by thresholding *S0* at its ``q``-th
+    percentile. With numba, the comparison and the extraction of the masked
+    voxels are fused into a single pass.
+
+    >>> S0, mask = _masked_S0(np.arange(10, dtype="int16"))
+    >>> S0.size, int(mask.sum()), np.allclose(S0, np.arange(4, 10) / 9)
+    (6, 6, True)
+
+    """
+    S0 = _normalize_S0(S0)
+    if mask is None and njit is not None:
+        mask = np.empty(S0.shape, dtype=bool)
+        masked = np.empty(S0.size, dtype=S0.dtype)
+        n_kept = _compress_above(S0.ravel(), _percentile(S0, q), mask.ravel(), masked)
+        return masked[:n_kept], mask
+
+    if mask is None:
+        mask = _threshold_mask(S0, q)
+    return S0[mask], mask
+
+
+def _chunk_slices(n_vox, n_chunks):
+    """
+    Split a voxel range into at most ``n_chunks`` contiguous slices.
+
+    All chunks have the same length, except the last one that takes the remainder.
+
+    >>> _chunk_slices(100, 4)
+    [slice(0, 25, None), slice(25, 50, None), slice(50, 75, None), slice(75, 100, None)]
+    >>> _chunk_slices(10, 4)
+    [slice(0, 3, None), slice(3, 6, None), slice(6, 9, None), slice(9, 10, None)]
+    >>> _chunk_slices(0, 4)
+    [slice(0, 0, None)]
+
+    """
+    if n_vox == 0:
+        return [slice(0, 0)]
+
+    step = -(-n_vox // n_chunks)  # ceil division
+    return [slice(i, min(i + step, n_vox)) for i in range(0, n_vox, step)]
+
+
+@contextmanager
+def _numba_threads(n_threads):
+    """Run numba's parallel kernels on at most ``n_threads`` threads within the block."""
+    if njit is None:
+        yield
+        return
+
+    previous = get_num_threads()
+    set_num_threads(min(n_threads, numba_config.NUMBA_NUM_THREADS))
+    try:
+        yield
+    finally:
+        set_num_threads(previous)
+
+
+def _mp_context():
+    """
+    Choose how worker processes are started.
+
+    Forking after numba has started its threading layer may deadlock, so
+    workers are then started from a clean process instead. Otherwise, the
+    platform's default is kept.
+
+    """
+    if njit is None:
+        return None
+
+    try:
+        threading_layer()
+    except ValueError:  # No parallel kernel has run yet
+        return None
+
+    if "forkserver" in get_all_start_methods():
+        return get_context("forkserver")
+    return get_context("spawn")
+
+
+def _jit(**options):
+    """Compile the decorated function with :obj:`numba.njit` if numba is installed."""
+    if njit is None:
+        return lambda func: func
+    return njit(**options)
+
+
+@_jit(parallel=True, fastmath=True, cache=True)
+def _fit_tensor_wls(design_matrix, design_pinv, signal, min_signal, weighted):
+    r"""
+    Solve the log-linearized tensor model voxel by voxel.
+
+    Parameters
+    ----------
+    design_matrix : :obj:`numpy.ndarray`
+        DIPY's tensor design matrix, shape (n_gradients, 7).
+    design_pinv : :obj:`numpy.ndarray`
+        Pseudo-inverse of the design matrix, shape (7, n_gradients).
+    signal : :obj:`numpy.ndarray`
+        Diffusion signal, shape (n_voxels, n_gradients).
+    min_signal : :obj:`float`
+        Signal values are clipped from below to this value before the logarithm.
+    weighted : :obj:`bool`
+        Whether the ordinary least squares estimate is refined by a weighted
+        least squares pass (as in :obj:`dipy.reconst.dti.wls_fit_tensor`).
+
+    Return
+    ------
+    params : :obj:`numpy.ndarray`
+        Lower-triangular tensor elements and :math:`-\log(S_0)`, shape (n_voxels, 7).
+
+    """
+    n_vox, n_grad = signal.shape
+    n_params = design_matrix.shape[1]
+    params = np.zeros((n_vox, n_params))
+    for i in prange(n_vox):
+        log_s = np.empty(n_grad)
+        for g in range(n_grad):
+            log_s[g] = np.log(max(signal[i, g], min_signal))
+
+        # Ordinary least squares estimate
+        for p in range(n_params):
+            for g in range(n_grad):
+                params[i, p] += design_pinv[p, g] * log_s[g]
+
+        if weighted:
+            # Least squares weighted by the OLS-predicted signal. As DIPY's
+            # pseudo-inverse, ``lstsq`` also copes with rank-deficient designs.
+            w_design = np.empty((n_grad, n_params))
+            w_log_s = np.empty(n_grad)
+            for g in range(n_grad):
+                w = 0.0
+                for p in range(n_params):
+                    w += design_matrix[g, p] * params[i, p]
+                w = np.exp(w)
+                w_log_s[g] = w * log_s[g]
+                for p in range(n_params):
+                    w_design[g, p] = w * design_matrix[g, p]
+            params[i] = np.linalg.lstsq(w_design, w_log_s)[0]
+    return params
+
+
+@_jit(parallel=True, cache=True)
+def _normalize_clip(out, data, max_value):
+    """Write ``min(max(data / max_value, 1e-5), 1)`` into ``out``, reading ``data`` once."""
+    for i in prange(data.size):
+        out[i] = min(max(data[i] / max_value, 1e-5), 1.0)
+
+
+@_jit(parallel=True, fastmath=True, cache=True)
+def _predict_tensor(params, S0, bvals, bvecs, out):
+    r"""
+    Predict the signal of fitted tensors, :math:`S_0 \exp(-b\, g^T D g)`.
+
+    Parameters
+    ----------
+    params : :obj:`numpy.ndarray`
+        Eigenvalues and (columnar) eigenvectors of each tensor, as stored by
+        :obj:`~dipy.reconst.dti.TensorFit`, shape (n_voxels, 12).
+    S0 : :obj:`numpy.ndarray`
+        Non diffusion-weighted signal, shape (n_voxels, ).
+    bvals : :obj:`numpy.ndarray`
+        *b*-values, shape (n_gradients, ).
+    bvecs : :obj:`numpy.ndarray`
+        *b*-vectors, shape (n_gradients, 3).
+    out : :obj:`numpy.ndarray`
+        Output array of predictions, shape (n_voxels, n_gradients).
+
+    The predictions are those of DIPY:
+
+    >>> bvecs = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0.6, 0.8], [0.6, 0, 0.8]])
+    >>> gtab = gradient_table([0, 1000, 1000, 2000, 3000], bvecs=bvecs)
+    >>> evecs = np.linalg.qr(np.random.default_rng(1234).normal(size=(3, 3)))[0]
+    >>> params = np.r_[[1.7e-3, 3e-4, 2e-4], evecs.ravel()][np.newaxis]
+    >>> out = np.empty((1, 5))
+    >>> _predict_tensor(params, np.array([0.8]), gtab.bvals, gtab.bvecs, out)
+    >>> fit = TensorFit(DipyTensorModel(gtab), params)
+    >>> np.allclose(out, fit.predict(gtab, S0=0.8))
+    True
+
+    """
+    n_vox = params.shape[0]
+    n_grad = bvals.shape[0]
+    for i in prange(n_vox):
+        for g in range(n_grad):
+            adc = 0.0
+            for j in range(3):
+                proj = (
+                    bvecs[g, 0] * params[i, 3 + j] +
+                    bvecs[g, 1] * params[i, 6 + j] +
+                    bvecs[g, 2] * params[i, 9 + j]
+                )
+                adc += params[i, j] * proj * proj
+            out[i, g] = S0[i] * np.exp(-bvals[g] * adc)
+
+
+@_jit(cache=True)
+def _compress_above(data, threshold, mask, out):
+    """Flag ``data > threshold`` into ``mask`` and pack those values, in order, into ``out``."""
+    n_kept = 0
+    for i in range(data.size):
+        keep = data[i] > threshold
+        mask[i] = keep
+        if keep:
+            out[n_kept] = data[i]
+            n_kept += 1
+    return n_kept
+
+
+def _jit_fittable(model):
+    """Check whether the compiled kernel can stand in for DIPY's fitting routine."""
+    if njit is None or model.args or model.kwargs:
+        return False
+    return model.fit_method in (ols_fit_tensor, wls_fit_tensor)
+
+
+# Eigenvalues are floored at ``_DIPY_TENSOR_TOL / -design_matrix.min()``, as in DIPY's
+# ols_fit_tensor and wls_fit_tensor, where this tolerance is hard-coded (``tol = 1e-6``).
+# Keep both in sync, so that the compiled fit does not drift from DIPY's.
+_DIPY_TENSOR_TOL = 1e-6
+
+
+def _jit_fit(model, data):
+    """
+    Fit a linear tensor model with the compiled kernel.
+
+    The fitted tensors are those estimated by DIPY:
+
+    >>> rng = np.random.default_rng(1234)
+    >>> bvecs = rng.normal(size=(12, 3))
+    >>> bvecs /= np.linalg.norm(bvecs, axis=1)[:, np.newaxis]
+    >>> gtab = gradient_table(np.r_[0, [1000] * 12], bvecs=np.vstack(([0, 0, 0], bvecs)))
+    >>> data = rng.uniform(200, 1000, size=(10, 13))
+    >>> model = DipyTensorModel(gtab)
+    >>> params, model_S0 = _jit_fit(model, data)
+    >>> fit = model.fit(data)
+    >>> np.allclose(params[:, :3], fit.evals), model_S0 is None
+    (True, True)
+    >>> np.allclose(TensorFit(model, params).predict(gtab), fit.predict(gtab))
+    True
+
+    """
+    design = np.ascontiguousarray(model.design_matrix, dtype=np.float64)
+    min_signal = model.min_signal
+    if min_signal is None:
+        min_signal = MIN_POSITIVE_SIGNAL
+
+    design_pinv = np.ascontiguousarray(np.linalg.pinv(design))
+
+    # The kernel's threads already use all cores: keep its LAPACK calls serial
+    with threadpool_limits(limits=1):
+        lo_tri = _fit_tensor_wls(
+            design,
+            design_pinv,
+            data,
+            min_signal,
+            model.fit_method is wls_fit_tensor,
+        )
+    params = eig_from_lo_tri(lo_tri, min_diffusivity=_DIPY_TENSOR_TOL / -design.min())
+    model_S0 = np.exp(-lo_tri[:, -1]) if model.return_S0_hat else None
+    return params, model_S0
+
+
+def _write_shared(shm_name, shape, dtype, index, value):
+    """Write ``value`` at ``index`` into an array backed by an existing shared memory block."""
+    shm = SharedMemory(name=shm_name)
+    try:
+        array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        try:
+            array[index] = value
+        finally:
+            del array
+    finally:
+        shm.close()
+
+
+# The tensor model of a worker process, and the arguments it was built from
+_worker_model = None
+_worker_model_args = None
+
+
+def _worker_tensor_model(gradient, model_kwargs):
+    """Return the worker's tensor model, only building it anew if its arguments change."""
+    global _worker_model, _worker_model_args
+
+    args = (gradient.tobytes(), gradient.shape, model_kwargs)
+    if _worker_model is None or args != _worker_model_args:
+        _worker_model = DipyTensorModel(_rasb2dipy(gradient), **model_kwargs)
+        _worker_model_args = args
+    return _worker_model
+
+
+def _model_fit(data, model_gradient, model_kwargs, shm_name, chunk, shape):
+    """Fit a chunk with the worker's model and write its parameters into shared memory."""
+    fit = _worker_tensor_model(model_gradient, model_kwargs).fit(data)
+    _write_shared(shm_name, shape, "float64", (chunk, slice(0, 12)), fit.model_params)
+    if shape[1] > 12:
+        _write_shared(shm_name, shape, "float64", (chunk, 12), fit.model_S0)
+
+
+def _predict_sub(
+    model_gradient,
+    model_kwargs,
+    params,
+    model_S0,
+    gradient,
+    S0_chunk,
+    step,
+    shm_name,
+    chunk,
+    shape,
+    dtype,
+):
+    """Call predict for chunk and write the predicted signal into shared memory."""
+    if S0_chunk is not None:
+        S0_chunk = S0_chunk.astype("float32", copy=False)
+
+    model = _worker_tensor_model(model_gradient, model_kwargs)
+    subfit = TensorFit(model, params, model_S0=model_S0)
+    predicted = subfit.predict(_rasb2dipy(gradient), S0=S0_chunk, step=step)
+    _write_shared(shm_name, shape, dtype, chunk, predicted)
+
+
+def _worker_init():
+    """Set up a worker process, limiting BLAS to one thread to avoid oversubscription."""
+    threadpool_limits(limits=1)